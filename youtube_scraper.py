@@ -1,30 +1,127 @@
 import os
-from datetime import datetime, timedelta
-
+import re
+import string
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 from dotenv import load_dotenv
 from googleapiclient.discovery import build
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from supabase import create_client, Client
 
 from youtube_transcript_api import YouTubeTranscriptApi
 
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+# Matches the videoId in watch, youtu.be and shorts links
+_VIDEO_ID_RE = re.compile(r"(?:v=|youtu\.be/|shorts/)([A-Za-z0-9_-]{11})")
+
+# Retries with exponential backoff for YouTube Data API requests on 429/5xx
+YOUTUBE_NUM_RETRIES = 5
+
+# Transcript languages to accept, in order of preference
+TRANSCRIPT_LANGUAGES = ["en", "pt", "pt-BR"]
+
+# Characters of the transcript included in the Gemini prompt
+TRANSCRIPT_EXCERPT_CHARS = 8000
+
+# Gemini evaluation prompt, filled in per video
+_EVALUATION_PROMPT = string.Template(
+    "Title: $title\nDescription: $description\nChannel: $channel\n"
+    "Evaluate the video’s quality and teaching methodology, focusing on the didactics used "
+    "for presenting and explaining algorithms and data structures. Was the content clear and engaging, "
+    "or did it lead to confusion? Provide a detailed evaluation based on the implementation and learning "
+    "of the following key topics:\n"
+    "1. Arrays\n"
+    "2. Linked Lists\n"
+    "3. Stacks\n"
+    "4. Trees\n"
+    "5. Graphs\n"
+    "6. Asymptotic Analysis\n"
+    "For each topic, assess whether it was included in the video, how it was implemented, and how effectively "
+    "it was taught. Highlight any strengths or areas for improvement in making these concepts understandable "
+    "and applicable for learners.\n"
+    "Transcript excerpt:\n$transcript"
+)
+
+# Error messages evaluate_video used to return, which may still be stored as analyses
+_FAILED_ANALYSIS_PREFIXES = ("Erro na requisição", "Erro ao processar a análise do vídeo")
+
+# Shared session so Gemini requests reuse pooled keep-alive connections and
+# back off on rate limits and transient server errors
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1.0,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+@lru_cache(maxsize=1)
+def load_config():
+    """
+    Loads the .env file and returns the API keys, Supabase settings and export options.
+    """
+    load_dotenv()
+    return {
+        "youtube_api_key": os.getenv("YOUTUBE_API_KEY"),
+        "gemini_key": os.getenv("GEMINI_API_KEY"),
+        "supabase_url": os.environ.get("SUPABASE_URL"),
+        "supabase_key": os.environ.get("SUPABASE_KEY"),
+        "save_parquet": os.getenv("SAVE_PARQUET", "").strip().lower() in ("1", "true", "yes"),
+    }
+
+
+@lru_cache(maxsize=1)
+def get_supabase_client(url: str, key: str) -> Client:
+    """
+    Returns a Supabase client for the given project.
+    """
+    return create_client(url, key)
 
 
+@lru_cache(maxsize=1)
 def get_youtube_service(api_key: str):
     """
     Returns an instance of the YouTube Data API service.
     """
-    return build("youtube", "v3", developerKey=api_key)
+    # Use the discovery document bundled with the client instead of fetching it
+    return build("youtube", "v3", developerKey=api_key, static_discovery=True)
 
 
 def search_videos(youtube, query: str, days: int = 7, max_results: int = 50):
     """
     Search for videos on YouTube based on a term (query) with pagination.
     """
-    date_video = (datetime.now() - timedelta(days=days)).isoformat("T") + "Z"
+    # publishedAfter must be an RFC 3339 timestamp in UTC
+    date_video = (
+        (datetime.now(timezone.utc) - timedelta(days=days))
+        .isoformat(timespec="seconds")
+        .replace("+00:00", "Z")
+    )
     results = []
+    seen_ids = set()
     total_results = 0
     next_page_token = None
 
@@ -42,20 +139,28 @@ def search_videos(youtube, query: str, days: int = 7, max_results: int = 50):
                 order="relevance",
                 pageToken=next_page_token,
             )
-            .execute()
+            .execute(num_retries=YOUTUBE_NUM_RETRIES)
         )
 
+        # Pages can repeat a video, so keep only the first occurrence of each videoId
+        video_ids = []
         for item in response.get("items", []):
-            if "id" in item and "videoId" in item["id"]:
-                video_id = item["id"]["videoId"]
-                video_response = (
-                    youtube.videos()
-                    .list(part="snippet,statistics,contentDetails", id=video_id)
-                    .execute()
-                )
-
-                if video_response["items"]:
-                    snippet = video_response["items"][0]["snippet"]
+            if "id" in item and "videoId" in item["id"] and item["id"]["videoId"] not in seen_ids:
+                seen_ids.add(item["id"]["videoId"])
+                video_ids.append(item["id"]["videoId"])
+
+        if video_ids:
+            # A single videos().list call accepts up to 50 comma-separated IDs
+            video_response = (
+                youtube.videos()
+                .list(part="snippet,statistics,contentDetails", id=",".join(video_ids))
+                .execute(num_retries=YOUTUBE_NUM_RETRIES)
+            )
+            snippets = {video["id"]: video["snippet"] for video in video_response.get("items", [])}
+
+            for video_id in video_ids:
+                snippet = snippets.get(video_id)
+                if snippet:
                     results.append(
                         {
                             "Title": snippet["title"],
@@ -80,21 +185,38 @@ def fetch_transcript(video_id):
     Fetches the transcript of a YouTube video using the YouTubeTranscriptApi.
     """
     try:
-        transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
+        transcript_list = YouTubeTranscriptApi.get_transcript(video_id, languages=TRANSCRIPT_LANGUAGES)
         # Concatenate transcript into a single string
         return " ".join([entry["text"] for entry in transcript_list])
     except Exception as e:
         print(f"Failed to fetch transcript for video {video_id}: {str(e)}")
         return None
 
-def save_transcripts(data, supabase):
+def fetch_transcripts(data, known_transcripts=None, max_workers: int = 10):
+    """
+    Returns the transcript of each video keyed by link, fetching only those not in known_transcripts.
+    """
+    known_transcripts = known_transcripts or {}
+    pending = [item for item in data if not known_transcripts.get(item["Link"])]
+
+    # Transcript downloads are independent blocking requests, so fetch them in parallel
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fetched = list(executor.map(lambda item: fetch_transcript(extract_video_id(item["Link"])), pending))
+
+    transcripts = {item["Link"]: known_transcripts.get(item["Link"]) for item in data}
+    transcripts.update(zip((item["Link"] for item in pending), fetched))
+    return transcripts
+
+def save_transcripts(data, supabase, transcripts, saved_videos):
     """
-    Fetches and saves transcripts for each video in the database.
+    Saves the transcripts of videos in the database that do not have one yet.
+    saved_videos are the rows returned by get_saved_videos before the run saved anything.
     """
+    transcribed_links = {row["link"] for row in saved_videos if row.get("transcript")}
+
     for item in data:
-        video_id = extract_video_id(item["Link"])
-        transcript = fetch_transcript(video_id)
-        if transcript:
+        transcript = transcripts.get(item["Link"])
+        if transcript and item["Link"] not in transcribed_links:
             response = supabase.table("videos").update({
                 "transcript": transcript
             }).eq("link", item["Link"]).execute()
@@ -105,7 +227,7 @@ def save_transcripts(data, supabase):
                 print(f"Failed to save transcript for video '{item['Title']}': {response.data}")
 
 
-def evaluate_video(title: str, description: str, channel: str, gemini_key: str):
+def evaluate_video(title: str, description: str, channel: str, transcript: str, gemini_key: str):
     """
     Sends a request to the Gemini model for video quality analysis.
     """
@@ -116,21 +238,11 @@ def evaluate_video(title: str, description: str, channel: str, gemini_key: str):
             {
                 "parts": [
                     {
-                        "text": (
-                            f"Title: {title}\nDescription: {description}\nChannel: {channel}\n"
-                            "Evaluate the video’s quality and teaching methodology, focusing on the didactics used "
-                            "for presenting and explaining algorithms and data structures. Was the content clear and engaging, "
-                            "or did it lead to confusion? Provide a detailed evaluation based on the implementation and learning "
-                            "of the following key topics:\n"
-                            "1. Arrays\n"
-                            "2. Linked Lists\n"
-                            "3. Stacks\n"
-                            "4. Trees\n"
-                            "5. Graphs\n"
-                            "6. Asymptotic Analysis\n"
-                            "For each topic, assess whether it was included in the video, how it was implemented, and how effectively "
-                            "it was taught. Highlight any strengths or areas for improvement in making these concepts understandable "
-                            "and applicable for learners."
+                        "text": _EVALUATION_PROMPT.substitute(
+                            title=title,
+                            description=description,
+                            channel=channel,
+                            transcript=transcript[:TRANSCRIPT_EXCERPT_CHARS],
                         )
                     }
                 ]
@@ -138,8 +250,9 @@ def evaluate_video(title: str, description: str, channel: str, gemini_key: str):
         ]
     }
 
-    response = requests.post(url, headers=headers, json=payload)
+    response = _SESSION.post(url, headers=headers, data=orjson.dumps(payload))
     
+    # Failures return None so the video is evaluated again on the next run
     if response.status_code == 200:
         # Extrair o texto relevante da resposta
         try:
@@ -147,23 +260,69 @@ def evaluate_video(title: str, description: str, channel: str, gemini_key: str):
             text = analysis["candidates"][0]["content"]["parts"][0]["text"]
             return text  # Retorna apenas o texto relevante
         except (KeyError, IndexError):
-            return "Erro ao processar a análise do vídeo."
+            print(f"Erro ao processar a análise do vídeo '{title}'.")
+            return None
     else:
-        return f"Erro na requisição: {response.status_code}"
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code == 200:
-        return response.json()
-    return {"error": response.text}
+        print(f"Erro na requisição para o vídeo '{title}': {response.status_code}")
+        return None
+
+def evaluate_videos(videos, gemini_key: str, transcripts, existing_analysis=None, max_workers: int = 10):
+    """
+    Evaluates the videos concurrently, adding the Gemini analysis to each one.
+    Videos with an analysis in existing_analysis (keyed by link) reuse it instead,
+    and videos without a transcript are left unevaluated.
+    """
+    existing_analysis = existing_analysis or {}
+
+    def evaluate(video):
+        print(f"Evaluating: {video['Title']}")
+        return evaluate_video(
+            title=video["Title"],
+            description=video["Description"],
+            channel=video["channel"],
+            transcript=transcripts[video["Link"]],
+            gemini_key=gemini_key,
+        )
+
+    pending = []
+    for video in videos:
+        if existing_analysis.get(video["Link"]):
+            video["Qualitative analysis"] = existing_analysis[video["Link"]]
+        elif not transcripts.get(video["Link"]):
+            print(f"Skipping evaluation of '{video['Title']}': no transcript available.")
+            video["Qualitative analysis"] = None
+        else:
+            pending.append(video)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        analyses = list(executor.map(evaluate, pending))
+
+    for video, analysis in zip(pending, analyses):
+        video["Qualitative analysis"] = analysis
+    return videos
 
 def file_in_use(file_name):
     """
-    Checks if a file is in use by trying to open it in append mode.
+    Checks if a file is in use by trying to take a non-blocking lock on it.
     """
+    if not os.path.exists(file_name):
+        return False
+    try:
+        fd = os.open(file_name, os.O_RDWR)
+    except OSError:
+        return True
     try:
-        with open(file_name, "a"):
-            return False
-    except IOError:
+        if sys.platform == "win32":
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+    except OSError:
         return True
+    finally:
+        os.close(fd)
 
 def save_results_to_excel(data, file_name: str = "youtube_videos_evaluated.xlsx"):
     """
@@ -174,44 +333,85 @@ def save_results_to_excel(data, file_name: str = "youtube_videos_evaluated.xlsx"
         file_name = f"youtube_videos_evaluated_{timestamp}.xlsx"
         print(f"File was open. Saving as a new file: {file_name}")
 
-    pd.DataFrame(data).to_excel(file_name, index=False)
+    # Keep long texts starting with a link as plain strings; xlsxwriter drops URLs over 2079 chars
+    with pd.ExcelWriter(
+        file_name, engine="xlsxwriter", engine_kwargs={"options": {"strings_to_urls": False}}
+    ) as writer:
+        pd.DataFrame(data).to_excel(writer, index=False)
+    print(f"Data saved in the file: {file_name}")
+
+def save_results_to_parquet(data, file_name: str = "youtube_videos_evaluated.parquet"):
+    """
+    Saves data in a Parquet file, building the Arrow table straight from the records.
+    """
+    table = pa.Table.from_pylist(data)
+    pq.write_table(table, file_name, compression="zstd")
     print(f"Data saved in the file: {file_name}")
 
 def extract_video_id(link: str):
     """
     Extracts the videoId from the YouTube link.
     """
-    return link.split("v=")[-1]
+    match = _VIDEO_ID_RE.search(link)
+    return match.group(1) if match else None
+
+def is_failed_analysis(analysis):
+    """
+    Checks if a stored analysis is missing or one of the error messages older runs saved.
+    """
+    return not analysis or analysis.startswith(_FAILED_ANALYSIS_PREFIXES)
 
-def is_video_in_database(supabase, video_id: str):
+def get_saved_videos(supabase, links):
     """
-    Checks if a video is already in the database based on its videoId.
+    Returns the rows of the 'videos' table whose link is among the given links.
     """
-    response = supabase.table("videos").select("id").eq("link", f"https://www.youtube.com/watch?v={video_id}").execute()
-    return len(response.data) > 0
+    if not links:
+        return []
+    response = supabase.table("videos").select("link, transcript, qualitative_analysis").in_("link", links).execute()
+    return response.data
 
-def save_database(data, supabase):
+def save_database(data, supabase, saved_videos):
     """
     Saves video data in the Supabase 'videos' table.
+    saved_videos are the rows returned by get_saved_videos for these videos.
     """
-    for item in data:
-        video_id = extract_video_id(item["Link"])
+    saved_analysis = {row["link"]: row["qualitative_analysis"] for row in saved_videos}
 
-        if is_video_in_database(supabase, video_id):
-            print(f"Video '{item['Title']}' já está no banco de dados. Ignorando...")
+    rows = []
+    for item in data:
+        analysis = item.get("Qualitative analysis")
+        if item["Link"] in saved_analysis:
+            # Store analyses produced for saved videos that had none, e.g. once a transcript appeared
+            if analysis and is_failed_analysis(saved_analysis[item["Link"]]):
+                response = supabase.table("videos").update({
+                    "qualitative_analysis": analysis
+                }).eq("link", item["Link"]).execute()
+
+                if response.data:
+                    print(f"Analysis for video '{item['Title']}' saved successfully.")
+                else:
+                    print(f"Failed to save analysis for video '{item['Title']}': {response.data}")
+            else:
+                print(f"Video '{item['Title']}' já está no banco de dados. Ignorando...")
             continue
-        response = supabase.table("videos").insert({
+        rows.append({
             "title": item["Title"],
             "description": item["Description"],
             "channel": item["channel"],
             "link": item["Link"],
-            "qualitative_analysis": item.get("Qualitative analysis"),
-        }).execute()
+            "qualitative_analysis": analysis,
+        })
 
-        if response.data:
-            print(f"Video '{item['Title']}' saved successfully.")
-        else:
-            print(f"Failed to save video '{item['Title']}': {response.data}")
+    if not rows:
+        return
+
+    # Insert every new video in a single request
+    response = supabase.table("videos").insert(rows).execute()
+
+    if response.data:
+        print(f"{len(response.data)} videos saved successfully.")
+    else:
+        print(f"Failed to save {len(rows)} videos: {response.data}")
 
 
 
@@ -219,36 +419,32 @@ def main():
     """
     Main function for searching and evaluating videos.
     """
-    load_dotenv()
-    youtube_api_key = os.getenv("YOUTUBE_API_KEY")
-    gemini_key = os.getenv("GEMINI_API_KEY")
-
-    url: str = os.environ.get("SUPABASE_URL")
-    key: str = os.environ.get("SUPABASE_KEY")
-    supabase: Client = create_client(url, key)
+    config = load_config()
+    gemini_key = config["gemini_key"]
+    supabase: Client = get_supabase_client(config["supabase_url"], config["supabase_key"])
 
-    youtube_service = get_youtube_service(youtube_api_key)
+    youtube_service = get_youtube_service(config["youtube_api_key"])
     query = "Algorithm+Advent of Code+Python+2024"  
     videos = search_videos(youtube_service, query, days=7, max_results=10)
 
 
 
-    results_with_analysis = []
-    for video in videos:
-        print(f"Evaluating: {video['Title']}")
-        analysis = evaluate_video(
-            title=video["Title"],
-            description=video["Description"],
-            channel=video["channel"],
-            gemini_key=gemini_key,
-        )
-        video["Qualitative analysis"] = analysis
-        results_with_analysis.append(video)
+    saved_videos = get_saved_videos(supabase, [video["Link"] for video in videos])
+    # Reuse analyses and transcripts already stored so those videos skip the network calls
+    existing_analysis = {
+        row["link"]: row["qualitative_analysis"]
+        for row in saved_videos
+        if not is_failed_analysis(row["qualitative_analysis"])
+    }
+    transcripts = fetch_transcripts(videos, {row["link"]: row["transcript"] for row in saved_videos})
+    results_with_analysis = evaluate_videos(videos, gemini_key, transcripts, existing_analysis)
 
     save_results_to_excel(results_with_analysis)
-    save_database(videos, supabase)
+    if config["save_parquet"]:
+        save_results_to_parquet(results_with_analysis)
+    save_database(videos, supabase, saved_videos)
 
-    save_transcripts(videos, supabase)
+    save_transcripts(videos, supabase, transcripts, saved_videos)
 
 
 if __name__ == "__main__":